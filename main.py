@@ -4,37 +4,195 @@
 # to prevent blocking I/O and worker timeouts.
 
 import firebase_admin
-from firebase_admin import credentials, firestore
-import google.cloud.firestore
+from firebase_admin import firestore_async
+from google.cloud.firestore import SERVER_TIMESTAMP
 import datetime
-import json
+import orjson
+import msgspec
+import hashlib
 import os
+import atexit
+import threading
 from flask import Flask, request, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
 import logging
 import time
+import random
 import asyncio
 import httpx # Use httpx for async requests
+from cachetools import TTLCache
 
 # --- Flask App Initialization ---
+# orjson writes datetimes as RFC 3339; naive values are treated as UTC.
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Routes Flask's jsonify and request.get_json through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# --- HTTP Client ---
+HTTP_TIMEOUTS = {"gemini": 90.0, "connect": 5.0}
+
+# Flask runs every async view on a fresh, short-lived event loop, so the shared
+# client (and its connection pool) lives on one long-lived background loop.
+_BACKGROUND_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_BACKGROUND_LOOP.run_forever, name="background-loop", daemon=True).start()
+
+# Connection failures are retried by the transport itself; HTTP-level
+# retries (429/5xx) are handled with backoff in _call_gemini.
+HTTP_CONNECT_RETRIES = 2
+
+HTTP_CLIENT = httpx.AsyncClient(
+    # A short connect timeout keeps the transport's connect retries cheap.
+    timeout=httpx.Timeout(HTTP_TIMEOUTS["gemini"], connect=HTTP_TIMEOUTS["connect"]),
+    headers={"Accept-Encoding": "gzip, br"},
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+        retries=HTTP_CONNECT_RETRIES,
+    ),
+)
+
+# Set once the negotiated HTTP version has been logged (expected: HTTP/2).
+_HTTP_VERSION_LOGGED = False
+
+def run_on_background_loop(coro):
+    """Runs a coroutine on the background loop and returns an awaitable for the caller's loop."""
+    return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, _BACKGROUND_LOOP))
+
+@atexit.register
+def _close_http_client():
+    """Closes the shared HTTP client on interpreter shutdown."""
+    asyncio.run_coroutine_threadsafe(HTTP_CLIENT.aclose(), _BACKGROUND_LOOP).result(timeout=5)
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight.
+_BACKGROUND_TASKS = set()
+
+def spawn_background_task(coro):
+    """Starts a fire-and-forget task. Must be called on the background loop."""
+    task = asyncio.ensure_future(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO)
 
 # --- Firebase Initialization ---
-try:
-    if not firebase_admin._apps:
-        firebase_admin.initialize_app()
-    db = firestore.client()
-    logging.info("Firestore client initialized successfully.")
-except Exception as e:
-    logging.error(f"Error initializing Firestore client: {e}", exc_info=True)
-    db = None
+# The async client is bound to the background loop, so every Firestore call
+# must be awaited there. The client is created on first use; a failed attempt
+# is retried by a later request, after a backoff, instead of leaving the
+# instance without a database.
+_DB = None
+_DB_LOCK = threading.Lock()
+_DB_FAILED_ATTEMPTS = 0
+_DB_RETRY_AT = 0.0
+
+def get_db():
+    """Returns the Firestore client, initializing it on first use, or None if that fails."""
+    global _DB, _DB_FAILED_ATTEMPTS, _DB_RETRY_AT
+    if _DB is not None:
+        return _DB
+    with _DB_LOCK:
+        if _DB is None and time.monotonic() >= _DB_RETRY_AT:
+            try:
+                try:
+                    firebase_admin.initialize_app()
+                except ValueError:
+                    pass # The default app already exists.
+                _DB = firestore_async.client()
+                _DB_FAILED_ATTEMPTS = 0
+                logging.info("Firestore client initialized successfully.")
+            except Exception as e:
+                _DB_RETRY_AT = time.monotonic() + backoff_delay(_DB_FAILED_ATTEMPTS)
+                _DB_FAILED_ATTEMPTS += 1
+                logging.error(f"Error initializing Firestore client: {e}", exc_info=True)
+    return _DB
 
 # --- Configuration ---
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
 GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-pro:generateContent?key={GEMINI_API_KEY}"
+GEMINI_HEADERS = {'Content-Type': 'application/json'}
+PAYLOAD_GEN_CONFIG = {"response_mime_type": "application/json"}
 CACHE_EXPIRATION_DAYS = 180
+# Cache hits this close to expiry are served as-is and refreshed in the background.
+STALE_WHILE_REVALIDATE_DAYS = int(os.environ.get("STALE_WHILE_REVALIDATE_DAYS", "7"))
+
+# In-flight LLM calls by document ID, so concurrent misses and refreshes for
+# the same key share one call. Only touched from the background loop, where
+# check-and-insert can't interleave, so it needs no lock.
+_INFLIGHT = {}
+
+# In-process L0 cache in front of Firestore; its TTL is far shorter than
+# CACHE_EXPIRATION_DAYS, so entries never need explicit invalidation.
+LOCAL_CACHE_SIZE = 4096
+LOCAL_CACHE_TTL_SECONDS = 3600
+_LOCAL_CACHE = TTLCache(maxsize=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL_SECONDS)
+_LOCAL_CACHE_LOCK = threading.Lock()
+
+# --- Gemini Response Schema ---
+# Only the fields we read are declared; msgspec skips everything else while decoding.
+class GeminiPart(msgspec.Struct):
+    text: str
+
+class GeminiContent(msgspec.Struct):
+    parts: list[GeminiPart]
+
+class GeminiCandidate(msgspec.Struct):
+    content: GeminiContent
+
+class GeminiResponse(msgspec.Struct):
+    candidates: list[GeminiCandidate]
+
+GEMINI_RESPONSE_DECODER = msgspec.json.Decoder(GeminiResponse)
+
+# --- Retry Policy (full-jitter exponential backoff) ---
+RETRY_BASE = 1.0
+RETRY_CAP = 30.0
+MAX_RETRIES = 5
+# Total time budget for one Gemini call, retries included. Must stay under the
+# server's request timeout (290s in the Procfile, 300s Cloud Run default).
+LLM_DEADLINE_SECONDS = 240.0
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504, 529})
+
+REQUIRED_FIELDS = frozenset({"year", "make", "model", "mileage", "zip_code", "expected_annual_mileage"})
+_STRIP_SPACES = str.maketrans('', '', ' ')
+
+def _norm(value):
+    """Normalizes a vehicle attribute for cache keys: uppercased, spaces removed."""
+    return str(value).upper().translate(_STRIP_SPACES)
+
+def local_cache_get(doc_id):
+    """Returns a cached response body for doc_id, or None."""
+    with _LOCAL_CACHE_LOCK:
+        return _LOCAL_CACHE.get(doc_id)
+
+def local_cache_set(doc_id, data):
+    """Stores a JSON-ready response body for doc_id in the in-process cache."""
+    with _LOCAL_CACHE_LOCK:
+        _LOCAL_CACHE[doc_id] = data
+
+def make_cache_doc_id(cache_key_raw):
+    """Hashes a raw cache key into a fixed-length, 16-char hex Firestore document ID."""
+    return hashlib.blake2b(cache_key_raw.encode("utf-8"), digest_size=8).hexdigest()
+
+# Legacy IDs are read as a fallback while cache entries migrate to hashed IDs.
+# Keys that are never requested again stay under their legacy IDs; once
+# CACHE_EXPIRATION_DAYS have passed they're all expired and can be removed
+# with a one-off cleanup, along with this fallback.
+def legacy_cache_doc_id(year, make, model, trim, mileage_range, zip_code):
+    """Returns the document ID used before cache keys were hashed."""
+    if trim:
+        return f"{year}_{make}_{model}_{trim}_{mileage_range}_{zip_code}"
+    return f"{year}_{make}_{model}_{mileage_range}_{zip_code}"
 
 def get_mileage_range(mileage):
     """Categorizes mileage into 10,000-mile ranges for better caching."""
@@ -43,25 +201,17 @@ def get_mileage_range(mileage):
     end = start + 10000
     return f"{start}-{end}"
 
-def create_llm_prompt(data):
-    """Creates a detailed, structured prompt for the Gemini LLM."""
-    trim_text = data.get('trim', '').strip()
-    if trim_text:
-        trim_info = f"- Trim: {trim_text}"
-    else:
-        trim_info = "- Trim: Not specified. Please use a popular or base trim for this model in your estimation."
-
-    return f"""
+_PROMPT_TEXT = """
     Please act as an expert car cost analyst. Based on the following vehicle data, provide a JSON object with estimated annual ownership costs.
 
     Vehicle Data:
-    - Year: {data['year']}
-    - Make: {data['make']}
-    - Model: {data['model']}
-    {trim_info}
-    - Current Mileage: {data['mileage']}
-    - Location (Zip Code): {data['zip_code']}
-    - Expected Annual Mileage: {data['expected_annual_mileage']}
+    - Year: {year}
+    - Make: {make}
+    - Model: {model}
+    {trim_line}
+    - Current Mileage: {mileage}
+    - Location (Zip Code): {zip_code}
+    - Expected Annual Mileage: {expected_annual_mileage}
 
     Provide your response as a single, minified JSON object with NO additional text, explanations, or markdown. The JSON object must have the following structure and keys:
     {{
@@ -82,21 +232,195 @@ def create_llm_prompt(data):
     - For "depreciation_percentages", provide an array of exactly 15 numbers. Each number represents the percentage of the car's original value lost in that year, starting from year 1. To ensure accuracy, this depreciation curve MUST be informed by current used car market prices and trends for this specific model. The values should be whole numbers or decimals (e.g., 15 for 15%) and should generally decrease over time. For example: [18, 12, 9, 8, 7, 6, 5, 4, 4, 3, 3, 2, 2, 2, 1].
     - For "annual_taxes_fees", include estimates for annual registration, title, and other state or local fees.
     """
+NO_TRIM_LINE = "- Trim: Not specified. Please use a popular or base trim for this model in your estimation."
+
+# Bound once at import; the no-trim variant has its trim clause pre-rendered.
+PROMPT_TMPL = _PROMPT_TEXT.format
+PROMPT_TMPL_NO_TRIM = _PROMPT_TEXT.replace("{trim_line}", NO_TRIM_LINE).format
+
+def _depreciation_15y_prompt(data):
+    """Creates a detailed, structured prompt for the Gemini LLM, with a 15-year depreciation curve."""
+    fields = {
+        'year': data['year'],
+        'make': data['make'],
+        'model': data['model'],
+        'mileage': data['mileage'],
+        'zip_code': data['zip_code'],
+        'expected_annual_mileage': data['expected_annual_mileage'],
+    }
+    trim_text = data.get('trim', '').strip()
+    if trim_text:
+        return PROMPT_TMPL(trim_line=f"- Trim: {trim_text}", **fields)
+    return PROMPT_TMPL_NO_TRIM(**fields)
+
+# Prompt builders by version; PROMPT_VERSION picks the one this deployment uses.
+PROMPTS = {
+    "depreciation_15y": _depreciation_15y_prompt,
+}
+PROMPT_VERSION = os.environ.get("PROMPT_VERSION", "depreciation_15y")
+# Resolved at import so an unknown PROMPT_VERSION fails at startup, not per request.
+create_llm_prompt = PROMPTS[PROMPT_VERSION]
+
+def backoff_delay(attempt):
+    """Returns a full-jitter exponential backoff delay in seconds."""
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * (2 ** attempt)))
+
+async def backoff(attempt, deadline):
+    """Sleeps for a full-jitter backoff delay, or returns False if no retry fits before the deadline."""
+    delay = backoff_delay(attempt)
+    if attempt == MAX_RETRIES - 1 or time.monotonic() + delay >= deadline:
+        return False
+    await asyncio.sleep(delay)
+    return True
+
+async def _call_gemini(payload):
+    """Posts a payload to the Gemini API with retries. Must run on the background loop."""
+    global _HTTP_VERSION_LOGGED
+    deadline = time.monotonic() + LLM_DEADLINE_SECONDS
+    for attempt in range(MAX_RETRIES):
+        try:
+            logging.info(f"Attempting async call to Gemini API (Attempt {attempt + 1}/{MAX_RETRIES})")
+            # httpx timeouts are per phase; wait_for keeps the whole attempt inside the deadline.
+            response = await asyncio.wait_for(
+                HTTP_CLIENT.post(GEMINI_API_URL, json=payload, headers=GEMINI_HEADERS),
+                timeout=deadline - time.monotonic(),
+            )
+        except (httpx.RequestError, asyncio.TimeoutError) as e:
+            logging.error(f"Request to Gemini API failed on attempt {attempt + 1}: {e}")
+            if not await backoff(attempt, deadline):
+                raise
+            continue
+
+        if response.status_code in RETRY_STATUSES:
+            logging.warning(f"Gemini API returned a retryable status: {response.status_code}.")
+            if await backoff(attempt, deadline):
+                continue
+
+        if not _HTTP_VERSION_LOGGED:
+            _HTTP_VERSION_LOGGED = True
+            logging.info(f"Gemini API negotiated {response.http_version}")
+
+        response.raise_for_status()
+        return response
+
+async def _fetch_estimates(request_json, doc_ref, cache_key_raw):
+    """Calls the LLM, caches the result and returns the response body. Must run on the background loop."""
+    prompt = create_llm_prompt(request_json)
+    payload = {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": PAYLOAD_GEN_CONFIG
+    }
+
+    response = await _call_gemini(payload)
+
+    llm_response_text = GEMINI_RESPONSE_DECODER.decode(response.content).candidates[0].content.parts[0].text
+    estimates = msgspec.json.decode(llm_response_text)
+    logging.info("Successfully received and parsed response from LLM.")
+
+    current_time_utc = datetime.datetime.now(datetime.timezone.utc)
+    response_data = {
+        "source": "live_llm",
+        "estimates": estimates,
+        "metadata": {
+            "year": request_json['year'],
+            "make": request_json['make'],
+            "model": request_json['model'],
+            "trim": request_json.get('trim', ''),
+            "cache_key_raw": cache_key_raw,
+            "last_updated": current_time_utc
+        }
+    }
+
+    # Firestore stamps the stored copy itself; the local time is only for the response body.
+    cache_data = {**response_data, "metadata": {**response_data["metadata"], "last_updated": SERVER_TIMESTAMP}}
+
+    # The user doesn't need to wait for the cache write to land.
+    spawn_background_task(_write_cache(doc_ref, cache_data))
+    local_cache_set(doc_ref.id, {**response_data, 'source': 'cache'})
+    return response_data
+
+async def fetch_estimates_once(request_json, doc_ref, cache_key_raw):
+    """Runs _fetch_estimates with at most one in-flight call per document. Must run on the background loop."""
+    task = _INFLIGHT.get(doc_ref.id)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_estimates(request_json, doc_ref, cache_key_raw))
+        _INFLIGHT[doc_ref.id] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(doc_ref.id, None))
+    else:
+        logging.info(f"Joining in-flight LLM call for document: {doc_ref.id}")
+    # Shielded so one caller going away doesn't cancel the call for the others.
+    return await asyncio.shield(task)
+
+def schedule_refresh(request_json, doc_ref, cache_key_raw):
+    """Refreshes a near-expiry cache entry in the background."""
+    asyncio.run_coroutine_threadsafe(_refresh(request_json, doc_ref, cache_key_raw), _BACKGROUND_LOOP)
+
+async def _refresh(request_json, doc_ref, cache_key_raw):
+    """Background task behind schedule_refresh."""
+    try:
+        logging.info(f"Refreshing near-expiry cache entry for document: {doc_ref.id}")
+        await fetch_estimates_once(request_json, doc_ref, cache_key_raw)
+    except Exception as e:
+        logging.error(f"Background refresh failed for document {doc_ref.id}: {e}", exc_info=True)
+
+async def _get_legacy_cache_doc(legacy_ref, doc_ref, cache_key_raw):
+    """Reads a cache entry stored under its legacy ID and migrates it. Must run on the background loop.
+
+    Fresh entries are copied to the hashed ID and the legacy document is deleted;
+    expired ones are only deleted, since the LLM result will replace them.
+    """
+    doc = await legacy_ref.get()
+    if doc.exists:
+        data = doc.to_dict()
+        last_updated = data.get('metadata', {}).get('last_updated')
+        fresh = last_updated and (datetime.datetime.now(datetime.timezone.utc) - last_updated).days < CACHE_EXPIRATION_DAYS
+        if fresh:
+            data['metadata']['cache_key_raw'] = cache_key_raw
+        spawn_background_task(_migrate_cache_doc(legacy_ref, doc_ref, data if fresh else None))
+    return doc
+
+async def _migrate_cache_doc(legacy_ref, doc_ref, data):
+    """Moves a legacy cache entry to its hashed ID (or just deletes it when data is None)."""
+    try:
+        if data is not None:
+            await doc_ref.set(data)
+        await legacy_ref.delete()
+        logging.info(f"Migrated legacy cache document {legacy_ref.id} to {doc_ref.id}")
+    except Exception as e:
+        logging.error(f"Failed to migrate legacy cache document {legacy_ref.id}: {e}", exc_info=True)
+
+async def _write_cache(doc_ref, data):
+    """Writes an estimate to Firestore, logging rather than raising on failure."""
+    try:
+        await doc_ref.set(data)
+        logging.info(f"Successfully cached data for document: {doc_ref.id}")
+    except Exception as e:
+        logging.error(f"Failed to cache data for document {doc_ref.id}: {e}", exc_info=True)
+
+@app.after_request
+def _cors(response):
+    """Adds the CORS origin header to every response."""
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    return response
 
 def _build_cors_preflight_response():
-    """Builds a CORS preflight response."""
-    response = Response()
-    response.headers.add("Access-Control-Allow-Origin", "*")
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
-    response.status_code = 204
+    """Builds a CORS preflight response; browsers may cache it for 24 hours."""
+    response = Response(status=204)
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization'
+    response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
+    response.headers['Access-Control-Max-Age'] = '86400'
     return response
 
-def _build_cors_actual_response(response):
-    """Builds a CORS actual response."""
-    response.headers.add("Access-Control-Allow-Origin", "*")
+def _json_response(data, status_code=200):
+    """Builds a JSON response."""
+    response = jsonify(data)
+    response.status_code = status_code
     return response
 
+def _error(message, status_code):
+    """Builds a JSON error response."""
+    return _json_response({"error": message}, status_code)
+
 @app.route('/', methods=['POST', 'OPTIONS'])
 async def getCarCostEstimate(): # Make the function asynchronous
     """HTTP Cloud Function to estimate car ownership costs."""
@@ -105,111 +429,78 @@ async def getCarCostEstimate(): # Make the function asynchronous
 
     logging.info("Function execution started.")
 
+    db = get_db()
     if db is None:
         logging.error("CRITICAL: Database client is not initialized.")
-        error_response = jsonify({"error": "Internal Server Error: Database not initialized."})
-        error_response.status_code = 500
-        return _build_cors_actual_response(error_response)
+        return _error("Internal Server Error: Database not initialized.", 500)
 
-    request_json = request.get_json(silent=True)
-    if not request_json:
+    try:
+        request_json = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        request_json = None
+    if not isinstance(request_json, dict) or not request_json:
         logging.warning("Invalid or missing JSON in request body.")
-        error_response = jsonify({"error": "Invalid JSON."})
-        error_response.status_code = 400
-        return _build_cors_actual_response(error_response)
-
-    required_fields = ["year", "make", "model", "mileage", "zip_code", "expected_annual_mileage"]
-    for field in required_fields:
-        if field not in request_json:
-            logging.warning(f"Missing required field in request: '{field}'")
-            error_response = jsonify({"error": f"Invalid request: '{field}' field is missing."})
-            error_response.status_code = 400
-            return _build_cors_actual_response(error_response)
+        return _error("Invalid JSON.", 400)
+
+    missing = REQUIRED_FIELDS.difference(request_json)
+    if missing:
+        missing_list = ", ".join(f"'{field}'" for field in sorted(missing))
+        logging.warning(f"Missing required fields in request: {missing_list}")
+        return _error(f"Invalid request: missing fields: {missing_list}.", 400)
 
     logging.info(f"Request validated successfully for: {request_json['year']} {request_json['make']} {request_json['model']}")
 
     year = int(request_json['year'])
-    make = str(request_json['make']).upper().replace(' ', '')
-    model = str(request_json['model']).upper().replace(' ', '')
-    trim = str(request_json.get('trim', '')).upper().replace(' ', '')
+    make = _norm(request_json['make'])
+    model = _norm(request_json['model'])
+    trim = _norm(request_json.get('trim', ''))
     mileage = int(request_json['mileage'])
     zip_code = str(request_json['zip_code'])
     mileage_range = get_mileage_range(mileage)
 
-    if trim:
-        doc_id = f"{year}_{make}_{model}_{trim}_{mileage_range}_{zip_code}"
-    else:
-        doc_id = f"{year}_{make}_{model}_{mileage_range}_{zip_code}"
-    
-    doc_ref = db.collection('car_cost_estimates').document(doc_id)
-    logging.info(f"Checking cache for document ID: {doc_id}")
+    cache_key_raw = f"{year}|{make}|{model}|{trim}|{mileage_range}|{zip_code}"
+    doc_id = make_cache_doc_id(cache_key_raw)
 
-    # Caching logic remains synchronous as Firestore SDK is sync
-    # ... (caching code omitted for brevity but is unchanged) ...
+    cached_data = local_cache_get(doc_id)
+    if cached_data is not None:
+        logging.info(f"Local cache HIT for document: {doc_id}")
+        return _json_response(cached_data)
 
-    logging.info(f"Cache MISS for document: {doc_id}. Calling LLM.")
+    doc_ref = db.collection('car_cost_estimates').document(doc_id)
+    logging.info(f"Checking cache for document ID: {doc_id} ({cache_key_raw})")
 
     try:
-        prompt = create_llm_prompt(request_json)
-        payload = {
-            "contents": [{"parts": [{"text": prompt}]}],
-            "generationConfig": {"response_mime_type": "application/json"}
-        }
+        doc = await run_on_background_loop(doc_ref.get())
+        if not doc.exists:
+            legacy_ref = db.collection('car_cost_estimates').document(
+                legacy_cache_doc_id(year, make, model, trim, mileage_range, zip_code))
+            doc = await run_on_background_loop(_get_legacy_cache_doc(legacy_ref, doc_ref, cache_key_raw))
+        if doc.exists:
+            cached_data = doc.to_dict()
+            last_updated = cached_data.get('metadata', {}).get('last_updated')
+            if last_updated:
+                age = datetime.datetime.now(datetime.timezone.utc) - last_updated
+                if age.days < CACHE_EXPIRATION_DAYS:
+                    logging.info(f"Cache HIT for document: {doc_id}")
+                    if age.days > CACHE_EXPIRATION_DAYS - STALE_WHILE_REVALIDATE_DAYS:
+                        schedule_refresh(request_json, doc_ref, cache_key_raw)
+                    cached_data['source'] = 'cache'
+                    # Firestore returns a datetime subclass, which orjson doesn't serialize natively;
+                    # a plain datetime gets the same RFC 3339 format as live results.
+                    cached_data['metadata']['last_updated'] = datetime.datetime.fromtimestamp(
+                        last_updated.timestamp(), datetime.timezone.utc)
+                    local_cache_set(doc_id, cached_data)
+                    return _json_response(cached_data)
+            logging.info(f"Cache STALE for document: {doc_id}")
+    except Exception as e:
+        logging.warning(f"Cache lookup failed for document {doc_id}, falling back to LLM: {e}")
 
-        async with httpx.AsyncClient(timeout=90.0) as client:
-            response = None
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    logging.info(f"Attempting async call to Gemini API (Attempt {attempt + 1}/{max_retries})")
-                    response = await client.post(GEMINI_API_URL, json=payload, headers={'Content-Type': 'application/json'})
-                    
-                    if 500 <= response.status_code < 600:
-                        logging.warning(f"Gemini API returned a server error: {response.status_code}. Retrying...")
-                        await asyncio.sleep(2 ** attempt)
-                        continue
-
-                    response.raise_for_status()
-                    break
-                
-                except httpx.RequestError as e:
-                    logging.error(f"Request to Gemini API failed on attempt {attempt + 1}: {e}")
-                    if attempt < max_retries - 1:
-                        await asyncio.sleep(2 ** attempt)
-                    else:
-                        raise
-
-        if response is None or not response.is_success:
-             raise Exception("Failed to get a successful response from Gemini API after multiple retries.")
-
-        llm_response_text = response.json()['candidates'][0]['content']['parts'][0]['text']
-        estimates = json.loads(llm_response_text)
-        logging.info("Successfully received and parsed response from LLM.")
-        
-        current_time_utc = datetime.datetime.now(datetime.timezone.utc)
-        response_data = {
-            "source": "live_llm",
-            "estimates": estimates,
-            "metadata": {
-                "year": request_json['year'],
-                "make": request_json['make'],
-                "model": request_json['model'],
-                "trim": request_json.get('trim', ''),
-                "last_updated": current_time_utc
-            }
-        }
-        
-        db.collection('car_cost_estimates').document(doc_id).set(response_data)
-        logging.info(f"Successfully cached data for document: {doc_id}")
+    logging.info(f"Cache MISS for document: {doc_id}. Calling LLM.")
 
-        response_data['metadata']['last_updated'] = current_time_utc.isoformat()
-        
-        success_response = jsonify(response_data)
-        success_response.status_code = 200
-        return _build_cors_actual_response(success_response)
+    try:
+        response_data = await run_on_background_loop(fetch_estimates_once(request_json, doc_ref, cache_key_raw))
+        return _json_response(response_data)
 
     except Exception as e:
         logging.error(f"An unexpected error occurred during LLM call or processing: {e}", exc_info=True)
-        error_response = jsonify({"error": "An internal server error occurred."})
-        error_response.status_code = 500
-        return _build_cors_actual_response(error_response)
+        return _error("An internal server error occurred.", 500)